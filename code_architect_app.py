@@ -8,21 +8,162 @@
 # - The control flow is now more stable and correctly displays the final state.
 
 # --- Pre-run Setup ---
-# Before running, you may need to install the 'requests' library:
-# pip install requests
+# Before running, you may need to install 'httpx' (with HTTP/2 support) and 'orjson':
+# pip install "httpx[http2]" orjson
 
 import streamlit as st
-import requests
-import json
+import httpx
+import certifi
+import orjson
+import asyncio
+import ast
+import functools
+import hashlib
+import os
+import random
+import re
+import ssl
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final
+
+# Optional: enables the semantic plan cache and relevance-ranked long-term memory
+# (pip install sentence-transformers).
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
 
 # --- Configuration ---
 API_KEY = ""
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={API_KEY}"
+API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:streamGenerateContent?alt=sse&key={API_KEY}"
+HTTP_TIMEOUT = 90  # seconds
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 8
+HTTP_MAX_CONNECTIONS = 16
+COMPLETE_FINISH_REASONS = ("STOP", "MAX_TOKENS")  # other finishReasons (SAFETY, RECITATION, ...) are not retried
+GEMINI_REQUESTS_PER_MINUTE = 15  # free-tier quota; raise for paid API keys
+MAX_CONCURRENT_SECTIONS = 4
+SECTIONS_PER_REQUEST = 3  # independent sections generated together in one JSON request
+LONG_TERM_MEMORY_MAX_SUMMARIES = 50
+LONG_TERM_MEMORY_TOKEN_BUDGET = 1000
+LONG_TERM_MEMORY_TOP_K = 3  # summaries retrieved per request when embeddings are available
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 256
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_CHUNK_WORDS = 128  # stays under the model's 256 word-piece input limit
+SEMANTIC_CACHE_PATH = ".pge_cache.npz"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Markdown code fences (```python / ```json / ```) on their own line or closing a line.
+MARKDOWN_FENCE_RE = re.compile(r"^[ \t]*```(?:python|json)?[ \t]*(?:\n|$)|[ \t]*```[ \t]*$", re.MULTILINE)
+
+# --- System Prompts ---
+PLANNER_SYSTEM_PROMPT: Final[str] = "You are a world-class software architect. Your task is to break down a prompt for a SINGLE-FILE application into a logical sequence of code sections. Your plan MUST be a JSON object with two root keys: 'plan', containing a list of objects, and 'first_section_code', containing the complete raw Python code for the FIRST section of the plan as a single string (no markdown). Each object must have four keys: 'section_name', 'description', 'depends_on' and 'needs_exact_code'. 'depends_on' is a list of the zero-based indices of EVERY earlier section whose names (imports, constants, functions, classes, variables) or behaviour this section uses; use an empty list ONLY when the section uses nothing defined by earlier sections. 'needs_exact_code' is the subset of 'depends_on' whose exact code, not just a summary, this section must see to be written correctly; it is usually empty. CRITICAL RULES: 1. For each section's 'description', you MUST explicitly extract and include any specific, critical requirements from the master prompt that are relevant to that section. 2. For example, if the prompt mentions a specific dictionary key or a UI element, that detail must be in the description for the relevant section. 3. Think sequentially for a single script: Imports -> Constants/Setup -> Functions/Classes -> Main execution logic. 4. The output must be ONLY the raw JSON object."
+SECTION_SYSTEM_PROMPT: Final[str] = "You are an expert Python programmer. Your task is to write a clean and functional block of code for a specific section of a larger script. CRITICAL RULES: 1. You MUST ONLY output the raw code for the requested section. 2. Do NOT include any explanations, comments, or markdown formatting like ```python ... ```. 3. Use the Long-Term and Short-Term memory to ensure your code is consistent with previously written code. 4. Ensure the code is complete for the given section. Do not use placeholders."
+BATCH_SECTION_SYSTEM_PROMPT: Final[str] = "You are an expert Python programmer. Your task is to write clean and functional blocks of code for several specific sections of a larger script. CRITICAL RULES: 1. You MUST respond with ONLY a JSON object of the form {\"sections\": [{\"name\": \"...\", \"code\": \"...\"}]}, with exactly one entry per requested section, in the order requested. 2. Each 'code' value must contain ONLY the raw code for its section, without explanations or markdown formatting. 3. Use the Long-Term and Short-Term memory to ensure your code is consistent with previously written code. 4. Ensure the code is complete for every section. Do not use placeholders."
+SUMMARIZER_SYSTEM_PROMPT: Final[str] = "You are a senior code analyst. Your task is to summarize the provided Python code block. Focus on the core functionality, key function names, and variable definitions. Your summary must be a single, dense, and concise sentence."
+REFINER_SYSTEM_PROMPT: Final[str] = "You are a Senior Software Engineer performing a final code review. Your task is to refine the provided script to perfection. CRITICAL RULES: 1. Analyze the user's original prompt and the complete generated script. 2. Correct any bugs, logical errors, or inconsistencies. 3. Remove any redundant or nonsensical code (e.g., incorrect `if __name__ == '__main__'` blocks, duplicate UI elements). 4. Ensure the code is 100% compliant with all requirements in the original prompt. 5. Your final output MUST be ONLY the raw, complete, and corrected Python code. Do not add any explanations or markdown."
+
+# Pooled HTTP/2 client shared by every request of a pipeline run (opened in run_pge_pipeline).
+# Its connection pool is bound to that run's event loop, so only its TLS context is process-cached.
+_client = None
+
+# Identical prompts within one pipeline run share a single request: (system, user, json_output) -> Task.
+_run_cache = {}
 
 # --- Helper Functions ---
-def make_gemini_request(system_prompt, user_prompt, retries=2, delay=20):
-    """Sends a request to the Gemini API using a direct HTTP POST request with retries."""
+@st.cache_resource
+def get_executor():
+    """Thread pool shared by all sessions for blocking work (embedding, disk writes)."""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="pge-worker")
+
+async def run_blocking(func, *args):
+    """Runs a blocking call on the shared thread pool so the event loop keeps serving the UI."""
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), functools.partial(func, *args))
+
+@st.cache_resource
+def get_ssl_context():
+    """Builds the TLS context (CA bundle load) once per process; shared read-only by every run's client."""
+    return ssl.create_default_context(cafile=certifi.where())
+
+class RateLimiter:
+    """Thread-safe sliding-window limiter: at most `rate` requests start in any `per`-second window."""
+
+    def __init__(self, rate, per=60.0):
+        self.rate = rate
+        self.per = per
+        self.grants = deque()  # start times of granted requests, ascending; may lie in the future
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Books the earliest start that keeps every window within the rate; returns seconds to wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            while self.grants and self.grants[0] <= now - self.per:
+                self.grants.popleft()
+            start = now if len(self.grants) < self.rate else max(now, self.grants[-self.rate] + self.per)
+            self.grants.append(start)
+            return start - now
+
+    async def acquire(self):
+        """Returns immediately while under the rate; otherwise sleeps just long enough to stay under it."""
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+@st.cache_resource
+def get_rate_limiter():
+    """Returns the process-wide limiter; the Gemini quota is shared by every session using the key."""
+    return RateLimiter(GEMINI_REQUESTS_PER_MINUTE, per=60.0)
+
+def strip_fences(text):
+    """Removes markdown code fences the model wraps around its output, in a single pass."""
+    return MARKDOWN_FENCE_RE.sub("", text).strip()
+
+def retry_after_seconds(response):
+    """Returns the server's requested wait from a numeric `Retry-After` header, or None."""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", "")))
+    except ValueError:
+        return None
+
+def backoff_delay(status_code, attempt):
+    """Seconds to wait before retrying: long, jittered backoff for rate limits; short for server errors."""
+    if status_code == 429:
+        return min(60, 2 ** attempt) + random.uniform(0, 1)
+    return 2 ** attempt * 0.5 + random.uniform(0, 0.5)
+
+async def make_gemini_request(system_prompt, user_prompt, placeholder=None, language="python", json_output=False):
+    """Sends a request to the Gemini API, reusing the in-flight or finished request for an identical prompt in this run.
+
+    Failed requests are forgotten, so a later identical prompt is sent again.
+    """
+    key = (system_prompt, user_prompt, json_output)
+    task = _run_cache.get(key)
+    if task is None:
+        task = asyncio.ensure_future(stream_gemini_request(system_prompt, user_prompt, placeholder, language, json_output))
+        _run_cache[key] = task
+    result = await asyncio.shield(task)
+    if result.startswith("Error:") and _run_cache.get(key) is task:
+        del _run_cache[key]
+    return result
+
+async def stream_gemini_request(system_prompt, user_prompt, placeholder=None, language="python", json_output=False, retries=5):
+    """Streams a response from the Gemini API over the pooled async HTTP client, with retries.
+
+    If a `placeholder` (an `st.empty()`) is given, the partial response is rendered into it
+    as it arrives. `json_output=True` asks the model for a JSON response. Returns the
+    complete response text.
+
+    Rate limits (429) honor `Retry-After` or back off exponentially; server and network
+    errors retry after a short backoff; empty, truncated or unparsable streams retry
+    immediately; other client errors (4xx) and responses the API stopped for any reason
+    other than STOP/MAX_TOKENS (e.g. SAFETY, RECITATION) fail without retrying.
+    """
     headers = {"Content-Type": "application/json"}
     payload = {
         "contents": [{"parts": [{"text": f"{system_prompt}\n\n{user_prompt}"}]}],
@@ -33,125 +174,573 @@ def make_gemini_request(system_prompt, user_prompt, retries=2, delay=20):
             "maxOutputTokens": 8192,
         },
     }
+    if json_output:
+        payload["generationConfig"]["responseMimeType"] = "application/json"
 
     for attempt in range(retries):
         try:
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=90)
-            response.raise_for_status()
-            
-            response_json = response.json()
-            candidate = response_json.get('candidates', [{}])[0]
-            content_part = candidate.get('content', {}).get('parts', [{}])[0]
-            result_text = content_part.get('text', '')
-
-            if not result_text:
-                st.warning("API returned an empty response.")
-                return "Error: Empty response from API."
-
-            time.sleep(1)
-            return result_text
-
-        except requests.exceptions.RequestException as e:
-            st.warning(f"API Request failed (Attempt {attempt + 1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(delay)
+            result_text, finish_reason = "", None
+            await get_rate_limiter().acquire()
+            async with _client.stream("POST", API_URL, headers=headers, content=orjson.dumps(payload)) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    response_json = orjson.loads(line[len("data:"):])
+                    finish_reason = response_json.get('promptFeedback', {}).get('blockReason') or finish_reason
+                    candidate = response_json.get('candidates', [{}])[0]
+                    finish_reason = candidate.get('finishReason') or finish_reason
+                    content_part = candidate.get('content', {}).get('parts', [{}])[0]
+                    result_text += content_part.get('text', '')
+                    if placeholder is not None and result_text:
+                        placeholder.code(result_text, language=language)
+
+            if finish_reason is not None and finish_reason not in COMPLETE_FINISH_REASONS:
+                st.error(f"API stopped the response (finishReason {finish_reason}).")
+                return f"Error: Response stopped by the API (finishReason {finish_reason})."
+            if result_text and finish_reason is not None:
+                return result_text
+            if result_text:
+                st.warning(f"API response stream was cut off (Attempt {attempt + 1}/{retries}).")
+                error, delay = "Error: Truncated response from API.", 0
             else:
-                st.error("API request failed after multiple retries.")
+                st.warning(f"API returned an empty response (Attempt {attempt + 1}/{retries}).")
+                error, delay = "Error: Empty response from API.", 0
+
+        except httpx.HTTPStatusError as e:
+            status_code = e.response.status_code
+            if status_code != 429 and status_code < 500:
+                st.error(f"API request rejected: {e}")
                 return f"Error: {e}"
-        except (KeyError, IndexError) as e:
-            st.error(f"Failed to parse API response. Error: {e}")
-            st.json(response.json())
-            return "Error: Could not parse API response."
-            
-    return "Error: API request failed after all retries."
-
-# --- AI-Powered Summarizer ---
-def summarize_code_block(code_block):
-    """Uses the AI to create an intelligent summary of a code block for long-term memory."""
-    system_prompt = "You are a senior code analyst. Your task is to summarize the provided Python code block. Focus on the core functionality, key function names, and variable definitions. Your summary must be a single, dense, and concise sentence."
+            st.warning(f"API Request failed (Attempt {attempt + 1}/{retries}): {e}")
+            error, delay = f"Error: {e}", None
+            if status_code == 429:
+                delay = retry_after_seconds(e.response)
+            if delay is None:
+                delay = backoff_delay(status_code, attempt)
+        except httpx.HTTPError as e:
+            st.warning(f"API Request failed (Attempt {attempt + 1}/{retries}): {e}")
+            error, delay = f"Error: {e}", backoff_delay(None, attempt)
+        except (KeyError, IndexError, orjson.JSONDecodeError) as e:
+            st.warning(f"Failed to parse API response (Attempt {attempt + 1}/{retries}). Error: {e}")
+            error, delay = "Error: Could not parse API response.", 0
+
+        if attempt < retries - 1:
+            await asyncio.sleep(delay)
+
+    st.error("API request failed after multiple retries.")
+    return error
+
+# --- Response Cache ---
+# st.cache_data cannot memoize coroutines, so successful responses are kept in a
+# process-wide store owned by st.cache_resource and shared across sessions.
+@st.cache_resource
+def get_response_cache():
+    """Returns the shared cache of Gemini responses: key -> (timestamp, response)."""
+    return OrderedDict()
+
+def response_cache_key(system_prompt, user_prompt):
+    """Hashes the stripped prompts so trivially re-formatted prompts share a cache entry."""
+    normalized = f"{system_prompt.strip()}\0{user_prompt.strip()}"
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+# --- Semantic Cache ---
+# Catches re-runs whose master prompt was only reworded. Prompts are compared chunk by
+# chunk, so an edit to any one part of a prompt is enough to miss. Responses are reused
+# only for the same system prompt, and only where the caller opts in (the planning step).
+@st.cache_resource
+def get_embedding_model():
+    """Loads the sentence-embedding model once per process, or returns None if it is not installed."""
+    if SentenceTransformer is None:
+        return None
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+def embed_chunks(model, text):
+    """Embeds the text in consecutive word chunks; returns one normalized row per chunk."""
+    words = text.split()
+    chunks = [" ".join(words[i:i + EMBEDDING_CHUNK_WORDS]) for i in range(0, len(words), EMBEDDING_CHUNK_WORDS)] or [""]
+    return model.encode(chunks, normalize_embeddings=True).astype(np.float32)
+
+def embed_text(model, text):
+    """Embeds the full text as the normalized mean of its chunk embeddings, for relevance ranking."""
+    vector = embed_chunks(model, text).mean(axis=0)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+@st.cache_resource
+def get_semantic_cache():
+    """Loads the persisted semantic cache once per process, or returns None if embeddings are unavailable."""
+    model = get_embedding_model()
+    if model is None:
+        return None
+    cache = {
+        "lock": threading.Lock(),
+        "save_lock": threading.Lock(),  # serializes file writes without blocking lookups
+        "chunk_embeddings": [],  # one (chunks, dim) matrix per cached prompt, oldest first
+        "system_keys": [],
+        "responses": [],
+        "created": [],  # time.time() of each entry
+    }
+    if os.path.exists(SEMANTIC_CACHE_PATH):
+        try:
+            with np.load(SEMANTIC_CACHE_PATH) as data:
+                offsets = np.cumsum(data["chunk_counts"])[:-1]
+                cache["chunk_embeddings"] = np.split(data["embeddings"].astype(np.float32), offsets) if len(data["chunk_counts"]) else []
+                cache["system_keys"] = data["system_keys"].tolist()
+                cache["responses"] = data["responses"].tolist()
+                cache["created"] = data["created"].tolist()
+            prune_semantic_cache(cache)
+        except (OSError, KeyError, ValueError) as e:
+            st.warning(f"Ignoring unreadable semantic cache file: {e}")
+    return cache
+
+def prune_semantic_cache(cache):
+    """Drops expired entries, then the oldest ones beyond the size cap; the caller holds the lock."""
+    now = time.time()
+    keep = [k for k, created in enumerate(cache["created"]) if now - created < RESPONSE_CACHE_TTL]
+    keep = keep[-RESPONSE_CACHE_MAX_ENTRIES:]
+    for field in ("chunk_embeddings", "system_keys", "responses", "created"):
+        cache[field] = [cache[field][k] for k in keep]
+
+def semantic_cache_lookup(cache, system_key, chunk_embeddings):
+    """Returns the response of the closest cached prompt that matches chunk for chunk, else None.
+
+    A cached prompt matches only if it has the same number of chunks and every aligned chunk
+    pair clears the threshold; the weakest pair decides, so one edited chunk is a miss.
+    """
+    best_score, best_response = SEMANTIC_CACHE_THRESHOLD, None
+    with cache["lock"]:
+        now = time.time()
+        for cached_key, cached_chunks, response, created in zip(
+            cache["system_keys"], cache["chunk_embeddings"], cache["responses"], cache["created"]
+        ):
+            if cached_key != system_key or cached_chunks.shape != chunk_embeddings.shape or now - created >= RESPONSE_CACHE_TTL:
+                continue
+            score = float(np.min(np.sum(cached_chunks * chunk_embeddings, axis=1)))
+            if score >= best_score:
+                best_score, best_response = score, response
+    return best_response
+
+def semantic_cache_store(cache, system_key, chunk_embeddings, response):
+    """Adds a response to the semantic cache, prunes it to the TTL and size cap, and persists it.
+
+    Runs on the worker pool, so it reports a failed save by returning the message instead of
+    calling Streamlit; returns None on success. The file is written from a snapshot, so
+    lookups are not blocked while it is saved.
+    """
+    with cache["save_lock"]:
+        with cache["lock"]:
+            cache["chunk_embeddings"].append(chunk_embeddings)
+            cache["system_keys"].append(system_key)
+            cache["responses"].append(response)
+            cache["created"].append(time.time())
+            prune_semantic_cache(cache)
+            snapshot = {field: list(cache[field]) for field in ("chunk_embeddings", "system_keys", "responses", "created")}
+        try:
+            np.savez(
+                SEMANTIC_CACHE_PATH,
+                embeddings=np.vstack(snapshot["chunk_embeddings"]),
+                chunk_counts=np.array([len(chunks) for chunks in snapshot["chunk_embeddings"]]),
+                system_keys=np.array(snapshot["system_keys"], dtype=str),
+                responses=np.array(snapshot["responses"], dtype=str),
+                created=np.array(snapshot["created"], dtype=np.float64),
+            )
+        except OSError as e:
+            return f"Could not persist the semantic cache: {e}"
+    return None
+
+def clear_response_caches():
+    """Empties the exact-match and semantic caches, including the persisted semantic cache file."""
+    get_response_cache.clear()
+    get_semantic_cache.clear()
+    if os.path.exists(SEMANTIC_CACHE_PATH):
+        os.remove(SEMANTIC_CACHE_PATH)
+
+async def cached_llm_call(system_prompt, user_prompt, semantic_text=None, placeholder=None, language="python", json_output=False):
+    """Returns the cached response for a repeated prompt, otherwise calls Gemini and caches the result.
+
+    If `semantic_text` (the user's own text, without any fixed prompt wrapper) is given, a cached
+    response whose semantic_text matches it chunk for chunk also counts as a hit.
+    `placeholder`, `language` and `json_output` are passed through to make_gemini_request.
+    """
+    cache = get_response_cache()
+    key = response_cache_key(system_prompt, user_prompt)
+    entry = cache.get(key)
+    if entry and time.time() - entry[0] < RESPONSE_CACHE_TTL:
+        return entry[1]
+
+    semantic_cache = get_semantic_cache() if semantic_text is not None else None
+    if semantic_cache is not None:
+        system_key = response_cache_key(system_prompt, "")
+        chunk_embeddings = await run_blocking(embed_chunks, get_embedding_model(), semantic_text)
+        response = semantic_cache_lookup(semantic_cache, system_key, chunk_embeddings)
+        if response is not None:
+            return response
+
+    response = await make_gemini_request(system_prompt, user_prompt, placeholder=placeholder, language=language, json_output=json_output)
+    if not response.startswith("Error:"):
+        cache[key] = (time.time(), response)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                break
+        if semantic_cache is not None:
+            error = await run_blocking(semantic_cache_store, semantic_cache, system_key, chunk_embeddings, response)
+            if error:
+                st.warning(error)
+    return response
+
+# --- Summarizers ---
+def format_arguments(args):
+    """Renders a function's parameter names, e.g. `a, b, *rest, key, **options`."""
+    names = [a.arg for a in args.posonlyargs + args.args]
+    if args.vararg:
+        names.append(f"*{args.vararg.arg}")
+    names.extend(a.arg for a in args.kwonlyargs)
+    if args.kwarg:
+        names.append(f"**{args.kwarg.arg}")
+    return ", ".join(names)
+
+def extract_code_summary(code_block):
+    """Summarizes a code block from its top-level definitions, without calling the AI.
+
+    Returns a line such as `IMPORTS: imports: os, st; defs: get_x(a, b), MyCls; consts: API_URL`,
+    or None if the block does not parse or defines nothing.
+    """
+    try:
+        tree = ast.parse(code_block)
+    except SyntaxError:
+        return None
+
+    imports, defs, consts = [], [], []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imports.extend(alias.asname or alias.name for alias in node.names)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            defs.append(f"{node.name}({format_arguments(node.args)})")
+        elif isinstance(node, ast.ClassDef):
+            defs.append(node.name)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                elements = target.elts if isinstance(target, ast.Tuple) else [target]
+                consts.extend(e.id for e in elements if isinstance(e, ast.Name))
+
+    parts = [f"{label}: {', '.join(names)}" for label, names in (("imports", imports), ("defs", defs), ("consts", consts)) if names]
+    if not parts:
+        return None
+    first_line = code_block.lstrip().splitlines()[0]
+    section = first_line[len("# --- SECTION:"):].strip(" -") if first_line.startswith("# --- SECTION:") else ""
+    summary = "; ".join(parts)
+    return f"{section}: {summary}" if section else summary
+
+async def summarize_code_block(code_block):
+    """Creates a summary of a code block for long-term memory.
+
+    The summary is extracted locally from the block's definitions; the AI is only asked
+    when the block cannot be parsed or defines nothing.
+    """
+    summary = extract_code_summary(code_block)
+    if summary:
+        return summary
+
     user_prompt = f"Please summarize this code block:\n\n```python\n{code_block}\n```"
-    summary = make_gemini_request(system_prompt, user_prompt)
+    summary = await cached_llm_call(SUMMARIZER_SYSTEM_PROMPT, user_prompt)
     if summary.startswith("Error:"):
         return f"{code_block.splitlines()[0]}\n{code_block[:250]}...\n\n"
     return summary
 
+def estimate_tokens(text):
+    """Rough token count for budgeting prompts (about four characters per token)."""
+    return len(text) // 4
+
+def trim_to_token_budget(memory_parts, token_budget=LONG_TERM_MEMORY_TOKEN_BUDGET):
+    """Drops the oldest entries of a memory deque (in place) until the joined text fits the token budget."""
+    while len(memory_parts) > 1 and estimate_tokens("\n".join(memory_parts)) > token_budget:
+        memory_parts.popleft()
+
+async def relevant_long_term_memory(plan, window, memory_parts, memory_embeddings, model):
+    """Builds the long-term memory text for a window of sections.
+
+    With an embedding model, only the LONG_TERM_MEMORY_TOP_K summaries most similar to the
+    sections' descriptions are kept, in their original order. The result is then fitted to
+    the token budget.
+    """
+    selected = deque(memory_parts)
+    if model is not None and len(memory_parts) > LONG_TERM_MEMORY_TOP_K:
+        query = "\n".join(f"{plan[j].get('section_name', '')}: {plan[j].get('description', '')}" for j in window)
+        query_embedding = await run_blocking(embed_text, model, query)
+        similarities = np.vstack(memory_embeddings) @ query_embedding
+        top = sorted(int(k) for k in np.argsort(similarities)[-LONG_TERM_MEMORY_TOP_K:])
+        selected = deque(memory_parts[k] for k in top)
+    trim_to_token_budget(selected)
+    return "\n".join(selected)
+
 # --- PGE Core Functions ---
-def pge_step_1_planning(master_prompt):
+def usable_first_section_code(value):
+    """Returns the planner's first-section code if it is non-empty, parseable Python, else None."""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    code = strip_fences(value)
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return None
+    return code
+
+async def pge_step_1_planning(master_prompt):
     """PGE Step 1: Analyze the master prompt and create a detailed, structured plan."""
     st.info("Architectural Planning Initiated...")
     with st.spinner("Step 1: Analyzing prompt and creating a structural plan..."):
-        system_prompt = "You are a world-class software architect. Your task is to break down a prompt for a SINGLE-FILE application into a logical sequence of code sections. Your plan MUST be a JSON object with a single root key named 'plan', containing a list of objects. Each object must have two keys: 'section_name' and 'description'. CRITICAL RULES: 1. For each section's 'description', you MUST explicitly extract and include any specific, critical requirements from the master prompt that are relevant to that section. 2. For example, if the prompt mentions a specific dictionary key or a UI element, that detail must be in the description for the relevant section. 3. Think sequentially for a single script: Imports -> Constants/Setup -> Functions/Classes -> Main execution logic. 4. The output must be ONLY the raw JSON object."
         user_prompt = f"Here is the detailed project request for a single-file application:\n\n---\n\n{master_prompt}\n\n---\n\nPlease create the JSON development plan."
 
-        response_text = make_gemini_request(system_prompt, user_prompt)
+        plan_placeholder = st.empty()
+        response_text = await cached_llm_call(PLANNER_SYSTEM_PROMPT, user_prompt, semantic_text=master_prompt, placeholder=plan_placeholder, language="json", json_output=True)
+        plan_placeholder.empty()
         if response_text.startswith("Error:"): return None
         try:
-            clean_response = response_text.strip().replace("```json", "").replace("```", "").strip()
-            plan = json.loads(clean_response)
+            clean_response = strip_fences(response_text)
+            plan = orjson.loads(clean_response)
             st.session_state.architect_plan = plan.get("plan", [])
+            st.session_state.first_section_code = usable_first_section_code(plan.get("first_section_code"))
+            if plan.get("first_section_code") and st.session_state.first_section_code is None:
+                st.warning("The planner's code for the first section is unusable; it will be generated separately.")
             st.success("✔ Step 1: Detailed Structural Plan created.")
             with st.expander("View Generated Plan", expanded=False): st.json(plan)
             return st.session_state.architect_plan
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             st.error("Error decoding the structural plan from the model.")
             st.text_area("Model Response to Debug", response_text, height=300)
             return None
 
-def pge_step_2_generation_loop(plan, recent_sections_to_keep=2):
-    """PGE Step 2: Iterate through plan, generate code with hybrid memory."""
+def earlier_section_indices(plan, index, key):
+    """Returns the valid earlier-section indices listed under `key` for section `index`, or None if absent."""
+    indices = plan[index].get(key)
+    if not isinstance(indices, list):
+        return None
+    return [d for d in indices if isinstance(d, int) and 0 <= d < index]
+
+def exact_code_dependencies(plan, index):
+    """Returns the indices of earlier sections whose exact code section `index` must see."""
+    return earlier_section_indices(plan, index, "needs_exact_code") or []
+
+def section_dependencies(plan, index):
+    """Returns the indices of earlier sections that must be generated before section `index`.
+
+    These are the sections in its `depends_on` and `needs_exact_code`; without a `depends_on`
+    list, a section waits for the one before it.
+    """
+    depends_on = earlier_section_indices(plan, index, "depends_on")
+    if depends_on is None:
+        depends_on = [index - 1] if index > 0 else []
+    return sorted(set(depends_on) | set(exact_code_dependencies(plan, index)))
+
+def next_independent_batch(plan, start):
+    """Collects the consecutive sections from `start` whose dependencies are all already generated."""
+    end = start + 1
+    while end < len(plan) and all(d < start for d in section_dependencies(plan, end)):
+        end += 1
+    return list(range(start, end))
+
+def short_term_context_for(plan, window, all_code_blocks, short_term_memory_blocks):
+    """Builds the short-term memory for a window of sections.
+
+    It holds the exact code of every earlier section listed in their `needs_exact_code`
+    (oldest first), followed by the most recent blocks.
+    """
+    dependencies = sorted({d for j in window for d in exact_code_dependencies(plan, j)})
+    dependency_blocks = [all_code_blocks[d] for d in dependencies if all_code_blocks[d] not in short_term_memory_blocks]
+    blocks = dependency_blocks + short_term_memory_blocks
+    return "\n\n".join(blocks) if blocks else "N/A"
+
+def format_section_block(section_name, clean_code):
+    """Labels a generated section so it can be located in the assembled script."""
+    return f"# --- SECTION: {section_name.upper()} ---\n{clean_code}\n"
+
+def section_prompts(step, index, long_term_memory, short_term_context):
+    """Builds the (system_prompt, user_prompt) pair for generating a single plan section."""
+    section_name = step.get("section_name", f"S{index+1}")
+    description = step.get("description", "")
+    user_prompt = f"**Long-Term Memory:**\n{long_term_memory or 'N/A'}\n---\n**Short-Term Memory:**\n{short_term_context}\n---\n**Current Task:** `{section_name}`\n**Instructions:** {description}"
+    return SECTION_SYSTEM_PROMPT, user_prompt
+
+async def generate_section(step, index, long_term_memory, short_term_context, semaphore):
+    """Generates the code for a single plan section. Returns the labelled block, or None on failure."""
+    section_name = step.get("section_name", f"S{index+1}")
+    status = st.status(f"Generating Section: `{section_name}`", expanded=True)
+    code_placeholder = status.empty()
+
+    system_prompt, user_prompt = section_prompts(step, index, long_term_memory, short_term_context)
+    async with semaphore:
+        generated_code = await cached_llm_call(system_prompt, user_prompt, placeholder=code_placeholder)
+    if generated_code.startswith("Error:"):
+        status.update(label=f"✖ Section `{section_name}` failed.", state="error")
+        return None
+
+    clean_code = strip_fences(generated_code)
+    code_placeholder.code(clean_code, language="python")
+    status.update(label=f"✔ Section `{section_name}` generated.", state="complete", expanded=False)
+    return format_section_block(section_name, clean_code)
+
+def parse_section_batch(response_text, expected_count):
+    """Extracts each section's code from a combined JSON response, or returns None if it is unusable."""
+    try:
+        sections = orjson.loads(strip_fences(response_text)).get("sections")
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
+    if not isinstance(sections, list) or len(sections) != expected_count:
+        return None
+    codes = [section.get("code") if isinstance(section, dict) else None for section in sections]
+    if not all(isinstance(code, str) and code.strip() for code in codes):
+        return None
+    return [strip_fences(code) for code in codes]
+
+async def generate_section_window(plan, window, long_term_memory, short_term_context, semaphore):
+    """Generates several independent sections with a single request. Returns their labelled blocks, or None on failure.
+
+    Falls back to one request per section if the combined JSON response cannot be used.
+    """
+    if len(window) == 1:
+        full_block = await generate_section(plan[window[0]], window[0], long_term_memory, short_term_context, semaphore)
+        return None if full_block is None else [full_block]
+
+    section_names = [plan[j].get("section_name", f"S{j+1}") for j in window]
+    names_label = ", ".join(f"`{name}`" for name in section_names)
+    status = st.status(f"Generating Sections: {names_label}", expanded=True)
+    json_placeholder = status.empty()
+
+    tasks = "\n".join(
+        f"{n}. `{name}`\n**Instructions:** {plan[j].get('description', '')}"
+        for n, (j, name) in enumerate(zip(window, section_names), start=1)
+    )
+    user_prompt = f"**Long-Term Memory:**\n{long_term_memory or 'N/A'}\n---\n**Short-Term Memory:**\n{short_term_context}\n---\n**Current Tasks:**\n{tasks}"
+
+    async with semaphore:
+        response_text = await cached_llm_call(BATCH_SECTION_SYSTEM_PROMPT, user_prompt, placeholder=json_placeholder, language="json", json_output=True)
+    json_placeholder.empty()
+    if response_text.startswith("Error:"):
+        status.update(label=f"✖ Sections {names_label} failed.", state="error")
+        return None
+
+    codes = parse_section_batch(response_text, len(window))
+    if codes is None:
+        status.update(label=f"Sections {names_label}: combined response unusable, generating one by one.", state="complete", expanded=False)
+        full_blocks = await asyncio.gather(*[
+            generate_section(plan[j], j, long_term_memory, short_term_context, semaphore) for j in window
+        ])
+        return None if any(block is None for block in full_blocks) else list(full_blocks)
+
+    for name, clean_code in zip(section_names, codes):
+        status.markdown(f"`{name}`")
+        status.code(clean_code, language="python")
+    status.update(label=f"✔ Sections {names_label} generated.", state="complete", expanded=False)
+    return [format_section_block(name, clean_code) for name, clean_code in zip(section_names, codes)]
+
+async def pge_step_2_generation_loop(plan, recent_sections_to_keep=2, first_section_code=None):
+    """PGE Step 2: Iterate through plan, generate code with hybrid memory.
+
+    Each request sees the exact code of the sections listed in its `needs_exact_code` plus the
+    most recent blocks. Consecutive sections whose dependencies are already written are generated
+    concurrently (bounded by MAX_CONCURRENT_SECTIONS), up to SECTIONS_PER_REQUEST of them
+    per request; memory is updated in plan order.
+    If the planner already wrote the first section (`first_section_code`), it is used as-is.
+    """
     st.info("Code Generation Initiated...")
-    long_term_memory = ""
+    long_term_memory_parts = deque(maxlen=LONG_TERM_MEMORY_MAX_SUMMARIES)
+    long_term_memory_embeddings = deque(maxlen=LONG_TERM_MEMORY_MAX_SUMMARIES)  # aligned with the parts
+    seen_summaries = set()
+    memory_model = get_embedding_model()
     short_term_memory_blocks = []
     all_code_blocks = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SECTIONS)
 
     progress_bar = st.progress(0, text="Starting code generation...")
-    for i, step in enumerate(plan):
-        section_name = step.get("section_name", f"S{i+1}")
-        description = step.get("description", "")
-        progress_text = f"Step {i+1}/{len(plan)}: Gen `{section_name}`..."
-        progress_bar.progress((i + 1) / len(plan), text=progress_text)
-
-        with st.status(f"Generating Section: `{section_name}`", expanded=False) as status:
-            system_prompt = "You are an expert Python programmer. Your task is to write a clean and functional block of code for a specific section of a larger script. CRITICAL RULES: 1. You MUST ONLY output the raw code for the requested section. 2. Do NOT include any explanations, comments, or markdown formatting like ```python ... ```. 3. Use the Long-Term and Short-Term memory to ensure your code is consistent with previously written code. 4. Ensure the code is complete for the given section. Do not use placeholders."
-            short_term_context = "\n\n".join(short_term_memory_blocks) if short_term_memory_blocks else "N/A"
-            user_prompt = f"**Long-Term Memory:**\n{long_term_memory or 'N/A'}\n---\n**Short-Term Memory:**\n{short_term_context}\n---\n**Current Task:** `{section_name}`\n**Instructions:** {description}"
-            
-            generated_code = make_gemini_request(system_prompt, user_prompt)
-            if generated_code.startswith("Error:"):
-                st.session_state.generation_failed = True
-                return None
-
-            clean_code = generated_code.strip().replace("```python", "").replace("```", "").strip()
-            full_block = f"# --- SECTION: {section_name.upper()} ---\n{clean_code}\n"
-            all_code_blocks.append(full_block)
+    i = 0
+    if first_section_code and plan:
+        section_name = plan[0].get("section_name", "S1")
+        clean_code = strip_fences(first_section_code)
+        full_block = format_section_block(section_name, clean_code)
+        all_code_blocks.append(full_block)
+        short_term_memory_blocks.append(full_block)
+        with st.status(f"✔ Section `{section_name}` generated with the plan.", state="complete", expanded=False):
+            st.code(clean_code, language="python")
+        i = 1
+
+    while i < len(plan):
+        batch = next_independent_batch(plan, i)
+        section_names = ", ".join(f"`{plan[j].get('section_name', f'S{j+1}')}`" for j in batch)
+        progress_text = f"Step {batch[-1]+1}/{len(plan)}: Gen {section_names}..."
+        progress_bar.progress((batch[-1] + 1) / len(plan), text=progress_text)
+
+        windows = [batch[k:k + SECTIONS_PER_REQUEST] for k in range(0, len(batch), SECTIONS_PER_REQUEST)]
+        window_memories = await asyncio.gather(*[
+            relevant_long_term_memory(plan, window, long_term_memory_parts, long_term_memory_embeddings, memory_model)
+            for window in windows
+        ])
+        window_blocks = await asyncio.gather(*[
+            generate_section_window(
+                plan, window, long_term_memory,
+                short_term_context_for(plan, window, all_code_blocks, short_term_memory_blocks), semaphore,
+            )
+            for window, long_term_memory in zip(windows, window_memories)
+        ])
+        if any(blocks is None for blocks in window_blocks):
+            st.session_state.generation_failed = True
+            return None
 
+        for full_block in (block for blocks in window_blocks for block in blocks):
+            all_code_blocks.append(full_block)
             short_term_memory_blocks.append(full_block)
             if len(short_term_memory_blocks) > recent_sections_to_keep:
                 block_to_summarize = short_term_memory_blocks.pop(0)
-                summary = summarize_code_block(block_to_summarize)
-                long_term_memory += f"- {summary}\n"
-            status.update(label=f"✔ Section `{section_name}` generated.", state="complete")
+                summary = await summarize_code_block(block_to_summarize)
+                memory_entry = f"- {summary}"
+                if memory_entry not in seen_summaries:
+                    seen_summaries.add(memory_entry)
+                    long_term_memory_parts.append(memory_entry)
+                    if memory_model is not None:
+                        long_term_memory_embeddings.append(await run_blocking(embed_text, memory_model, summary))
+        i = batch[-1] + 1
 
     progress_bar.empty()
     st.success("✔ Initial Code Generation Completed.")
     return "\n".join(all_code_blocks)
 
-def pge_step_3_refinement(generated_code, master_prompt):
+async def pge_step_3_refinement(generated_code, master_prompt):
     """PGE Step 3: Review the complete code against the prompt and correct errors."""
     st.info("Self-Correction and Refinement Initiated...")
     with st.spinner("Step 3: Performing final review and correcting the full script..."):
-        system_prompt = "You are a Senior Software Engineer performing a final code review. Your task is to refine the provided script to perfection. CRITICAL RULES: 1. Analyze the user's original prompt and the complete generated script. 2. Correct any bugs, logical errors, or inconsistencies. 3. Remove any redundant or nonsensical code (e.g., incorrect `if __name__ == '__main__'` blocks, duplicate UI elements). 4. Ensure the code is 100% compliant with all requirements in the original prompt. 5. Your final output MUST be ONLY the raw, complete, and corrected Python code. Do not add any explanations or markdown."
         user_prompt = f"**Original Prompt:**\n{master_prompt}\n---\n**Script to Correct:**\n```python\n{generated_code}\n```"
         
-        corrected_code = make_gemini_request(system_prompt, user_prompt)
+        review_placeholder = st.empty()
+        corrected_code = await cached_llm_call(REFINER_SYSTEM_PROMPT, user_prompt, placeholder=review_placeholder)
+        review_placeholder.empty()
         if corrected_code.startswith("Error:"):
             st.error("Self-correction step failed. Returning uncorrected code.")
             return generated_code
 
-        clean_code = corrected_code.strip().replace("```python", "").replace("```", "").strip()
+        clean_code = strip_fences(corrected_code)
         st.success("✔ Step 3: Self-Correction Completed.")
         return clean_code
 
+def artifact_key(master_prompt, recent_sections_to_keep):
+    """Identifies a generation's inputs so its finished code can be reused within the session."""
+    return hashlib.sha1(f"{recent_sections_to_keep}\0{master_prompt}".encode("utf-8")).hexdigest()
+
+async def run_pge_pipeline(master_prompt, recent_sections_to_keep):
+    """Runs the three PGE steps in order. Returns the final code, or None if generation failed."""
+    global _client
+    _run_cache.clear()
+    limits = httpx.Limits(max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, max_connections=HTTP_MAX_CONNECTIONS)
+    async with httpx.AsyncClient(http2=True, timeout=HTTP_TIMEOUT, limits=limits, verify=get_ssl_context()) as _client:
+        plan = await pge_step_1_planning(master_prompt)
+        if not plan:
+            return None
+        generated_code = await pge_step_2_generation_loop(plan, recent_sections_to_keep, st.session_state.first_section_code)
+        if not generated_code:
+            return None
+        return await pge_step_3_refinement(generated_code, master_prompt)
+
 # --- Streamlit UI ---
 st.set_page_config(layout="wide", page_title="PGE Single-File Architect")
 
@@ -160,6 +749,7 @@ if 'final_code' not in st.session_state: st.session_state.final_code = ""
 if 'generation_failed' not in st.session_state: st.session_state.generation_failed = False
 if 'start_generation' not in st.session_state: st.session_state.start_generation = False
 if 'master_prompt' not in st.session_state: st.session_state.master_prompt = ""
+if 'artifacts' not in st.session_state: st.session_state.artifacts = {}
 
 st.title("🏗️ PGE Single-File Architect v5.5")
 st.markdown("An AI assistant with self-correction and intelligent memory.")
@@ -168,6 +758,10 @@ st.markdown("---")
 with st.sidebar:
     st.header("🧠 Memory Settings")
     recent_sections_to_keep = st.slider("Short-Term Memory Window", 1, 5, 2, 1)
+    if st.button("Clear cache", use_container_width=True):
+        clear_response_caches()
+        st.session_state.artifacts = {}
+        st.toast("Caches cleared.")
     st.markdown("---")
     st.header("How It Works")
     st.markdown("""1.  **Plan:** Creates a detailed plan.\n2.  **Generate:** Writes code section-by-section.\n3.  **Refine:** Performs a final "self-correction" pass.""")
@@ -178,22 +772,29 @@ with col1:
     master_prompt_input = st.text_area("Enter your detailed prompt...", height=400, key="prompt_input")
 
     if st.button("Generate Application", use_container_width=True, disabled=(not master_prompt_input)):
-        st.session_state.final_code = ""
-        st.session_state.generation_failed = False
-        st.session_state.architect_plan = []
-        st.session_state.master_prompt = master_prompt_input
-        st.session_state.start_generation = True
-        st.rerun()
+        requested_key = artifact_key(master_prompt_input, recent_sections_to_keep)
+        if requested_key in st.session_state.artifacts:
+            # Unchanged prompt and settings: show the code generated earlier in this session instead of re-billing.
+            st.session_state.final_code = st.session_state.artifacts[requested_key]
+            st.session_state.generation_failed = False
+            st.session_state.master_prompt = master_prompt_input
+            st.toast("Showing the code already generated for this prompt.")
+        else:
+            st.session_state.final_code = ""
+            st.session_state.generation_failed = False
+            st.session_state.architect_plan = []
+            st.session_state.first_section_code = None
+            st.session_state.master_prompt = master_prompt_input
+            st.session_state.start_generation = True
+            st.rerun()
 
 # --- Main Process Controller (CORRECTED LOGIC) ---
 if st.session_state.start_generation:
     # This block now runs on the rerun triggered by the button
-    plan = pge_step_1_planning(st.session_state.master_prompt)
-    if plan:
-        generated_code = pge_step_2_generation_loop(plan, recent_sections_to_keep)
-        if generated_code:
-            final_code = pge_step_3_refinement(generated_code, st.session_state.master_prompt)
-            st.session_state.final_code = final_code
+    final_code = asyncio.run(run_pge_pipeline(st.session_state.master_prompt, recent_sections_to_keep))
+    if final_code:
+        st.session_state.final_code = final_code
+        st.session_state.artifacts[artifact_key(st.session_state.master_prompt, recent_sections_to_keep)] = final_code
     
     # Reset the trigger AFTER the entire process is complete
     st.session_state.start_generation = False